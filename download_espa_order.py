@@ -20,16 +20,18 @@ Changes:
 """
 import argparse
 import base64
+import errno
 import os
 import random
-import shutil
 import sys
 import platform
+import threading
 import time
 import json
 import hashlib
 import logging
 from getpass import getpass
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info[0] == 3:
     import urllib.request as ul
@@ -47,19 +49,85 @@ LOGGER = logging.getLogger(__name__)
 USERAGENT = ('EspaBulkDownloader/{v} ({s}) Python/{p}'
              .format(v=__version__, s=platform.platform(aliased=True),
                      p=platform.python_version()))
+CHUNK_SIZE = 1024 * 1024  # bytes read per block while streaming a download
+POOL_TIMEOUT = 7 * 24 * 60 * 60  # seconds; bounds a wait on the download pool
+
+
+def content_size(status, headers, first_byte):
+    """
+    Total size of a remote file, taken from the response to a ranged GET
+
+    args:
+        status - HTTP status code of the response
+        headers - response headers
+        first_byte - offset requested in the Range header
+
+    returns:
+        Total size in bytes, or None if the server did not report it
+    """
+    content_range = headers.get('Content-Range') or ''
+    if status == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[-1]
+        if total.isdigit():
+            return int(total)
+    if headers.get('Content-Length'):
+        length = int(headers.get('Content-Length'))
+        return length + first_byte if status == 206 else length
+    return None
+
+
+def partial_size(path):
+    """ Bytes already on disk for a resumable download (0 if none) """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def update_digest(digest, path):
+    """ Feed the contents of a local file into a hashlib object, in CHUNK_SIZE blocks """
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def append_stream(blocks, tmp_scene_path, skip=0, digest=None):
+    """
+    Append a response body to a partial download
+
+    args:
+        blocks - iterable of byte strings read from the response
+        tmp_scene_path - partial file to append to
+        skip - leading bytes of the body to discard (already on disk)
+        digest - optional hashlib object updated with every byte written
+
+    returns:
+        Size of the partial file afterwards
+    """
+    with open(tmp_scene_path, 'ab') as target:
+        for block in blocks:
+            if skip:
+                block, skip = block[skip:], max(0, skip - len(block))
+            if block:
+                target.write(block)
+                if digest is not None:
+                    digest.update(block)
+    return os.path.getsize(tmp_scene_path)
 
 
 class HTTPSHandler(object):
     """ Python standard library TLS-secured HTTP/REST communications """
     def _set_ssl_context(self):
         try:
-            from ssl import SSLContext, PROTOCOL_TLSv1_2
+            from ssl import create_default_context
         except ImportError:
             msg = ('Cannot import SSL, HTTPS will not work. '
                    'Try `pip install requests` on Python < 2.7.9')
             raise ImportError(msg)
         else:
-            self.context = SSLContext(PROTOCOL_TLSv1_2)
+            # Let OpenSSL negotiate the newest protocol and cipher (TLS 1.3, AES-GCM)
+            self.context = create_default_context()
 
     def __init__(self, host=''):
         self.host = host
@@ -83,82 +151,84 @@ class HTTPSHandler(object):
         response = self.opener.open(request, data=body)
         return json.loads(response.read().decode())
 
-    def _download_bytes(self, full_url, first_byte, tmp_scene_path):
+    def _download_bytes(self, full_url, first_byte, tmp_scene_path, digest=None):
         request = ul.Request(full_url)
         request.headers['Range'] = 'bytes={}-'.format(first_byte)
 
-        with open(tmp_scene_path, 'ab') as target:
+        try:
             source = self.opener.open(request)
-            shutil.copyfileobj(source, target)
-
-        return os.path.getsize(tmp_scene_path)
-
-    def download(self, uri, target_path, verbose=False):
-        request = ul.Request(self.host + uri)
-        request.get_method = lambda: 'HEAD'
+        except ul.HTTPError as exc:
+            if exc.code != 416:
+                raise
+            # Range not satisfiable: the partial file already holds every byte
+            return first_byte, first_byte
+
+        status = source.getcode()
+        file_size = content_size(status, source.headers, first_byte)
+
+        # A 200 means the server ignored the Range header and resent everything
+        skip = first_byte if status == 200 else 0
+        first_byte = append_stream(iter(lambda: source.read(CHUNK_SIZE), b''),
+                                   tmp_scene_path, skip, digest)
+        return first_byte, file_size or first_byte
+
+    def download(self, uri, target_path, verbose=False, digest=None):
+        tmp_scene_path = target_path + '.part'
+        first_byte = partial_size(tmp_scene_path)
+        if digest is not None and first_byte:
+            update_digest(digest, tmp_scene_path)
 
-        head = self.opener.open(request)
-
-        file_size = int(head.headers['Content-Length'])
-
-        first_byte, tmp_scene_path = 0, target_path + '.part'
-        if os.path.exists(tmp_scene_path):
-            first_byte = os.path.getsize(tmp_scene_path)
-
-        while first_byte < file_size:
-            first_byte = self._download_bytes(self.host + uri, first_byte, tmp_scene_path)
+        file_size = None
+        while file_size is None or first_byte < file_size:
+            first_byte, file_size = self._download_bytes(self.host + uri, first_byte,
+                                                         tmp_scene_path, digest)
 
-        if first_byte >= file_size:
-            os.rename(tmp_scene_path, target_path)
+        os.rename(tmp_scene_path, target_path)
         return target_path
 
 
 class RequestsHandler(object):
-
+    """ Requests-based HTTP/REST communications, reusing one keep-alive session """
     def __init__(self, host=''):
         self.host = host
-        self.creds = None
-        self.headers = {}
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = (USERAGENT + ' (Requests/%s)'
+                                              % requests.__version__)
 
     def auth(self, username, password):
-        basic = ('%s:%s' % (username, password)).encode('ascii')
-        self.creds = (username, password)
-        self.headers = {
-                'User-Agent': USERAGENT + ' (Requests/%s)' % requests.__version__
-        }
+        self.session.auth = (username, password)
 
     def get(self, uri, data=None):
-        response = requests.get(self.host+uri, json=data,
-                                headers=self.headers, auth=self.creds)
+        response = self.session.get(self.host+uri, json=data)
         response.raise_for_status()
         results = response.json()
         return results
 
-    def download(self, uri, target_path, verbose=False):
+    def download(self, uri, target_path, verbose=False, digest=None):
         fileurl = self.host + uri
 
-        head = requests.head(fileurl)
+        tmp_scene_path = target_path + '.part'
+        first_byte = partial_size(tmp_scene_path)
+        if digest is not None and first_byte:
+            update_digest(digest, tmp_scene_path)
 
-        file_size = None
-        if 'Content-Length' in head.headers:
-            file_size = int(head.headers['Content-Length'])
+        sock = self.session.get(fileurl, headers={'Range': 'bytes=%d-' % first_byte},
+                                stream=True)
 
-        first_byte, tmp_scene_path = 0, target_path + '.part'
-        if os.path.exists(tmp_scene_path):
-            first_byte = os.path.getsize(tmp_scene_path)
+        # Range not satisfiable: the partial file already holds every byte
+        if sock.status_code != 416:
+            sock.raise_for_status()
+            file_size = content_size(sock.status_code, sock.headers, first_byte)
 
-        self.headers.update({'Range': 'bytes=%d-' % first_byte})
-        sock = requests.get(fileurl, headers=self.headers, stream=True)
+            # A 200 means the server ignored the Range header and resent everything
+            skip = first_byte if sock.status_code == 200 else 0
+            size = append_stream(sock.iter_content(chunk_size=CHUNK_SIZE),
+                                 tmp_scene_path, skip, digest)
 
-        f = open(tmp_scene_path, 'ab')
-        bytes_in_mb = 1024*1024
-        for block in sock.iter_content(chunk_size=bytes_in_mb):
-            if block:
-                f.write(block)
-        f.close()
+            if file_size is not None and size < file_size:
+                raise IOError('Incomplete download: {0} of {1} bytes'.format(size, file_size))
 
-        if os.path.getsize(tmp_scene_path) >= file_size:
-            os.rename(tmp_scene_path, target_path)
+        os.rename(tmp_scene_path, target_path)
         return target_path
 
 class Api(object):
@@ -222,12 +292,10 @@ class Scene(object):
         self.filename = parts[-1]
         self.name = self.filename.split('.tar.gz')[0]
 
-    @classmethod
-    def checksum(cls):
-        cls.srcurl = str(cls.srcurl).replace('.tar.gz', '.md5')
-        cls.filename = cls.filename.replace('.tar.gz', '.md5')
-        cls.name = '%s MD5 checksum' % cls.name
-        return cls
+    def checksum(self):
+        md5 = Scene(self.srcurl.replace('.tar.gz', '.md5'))
+        md5.name = '%s MD5 checksum' % self.name
+        return md5
 
 
 class LocalStorage(object):
@@ -236,19 +304,31 @@ class LocalStorage(object):
         self.basedir = basedir
         self.no_order_directories = no_order_directories
         self.verbose = verbose
-        if requests:
-            self.handler = RequestsHandler()
-        else:
-            self.handler = HTTPSHandler()
+        self.known_directories = set()
+        self.local = threading.local()
+
+    @property
+    def handler(self):
+        # requests.Session is not documented as thread-safe, so each
+        # download thread gets a handler (and session) of its own
+        if not hasattr(self.local, 'handler'):
+            self.local.handler = RequestsHandler() if requests else HTTPSHandler()
+        return self.local.handler
 
     def directory_path(self, scene):
         if self.no_order_directories:
             path = self.basedir
         else:
             path = os.path.join(self.basedir, scene.orderid)
-        if not os.path.exists(path):
+        if path in self.known_directories:
+            return path
+        try:
             os.makedirs(path)
             LOGGER.debug("Created target_directory: %s " % path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self.known_directories.add(path)
         return path
 
     def scene_path(self, scene):
@@ -257,6 +337,14 @@ class LocalStorage(object):
     def is_stored(self, scene):
         return os.path.exists(self.scene_path(scene))
 
+    def verify(self, scene, md5, actual):
+        """ Warn when a downloaded scene's digest does not match its MD5 checksum file """
+        with open(self.scene_path(md5)) as f:
+            expected = (f.read().split() or [''])[0].lower()
+        if actual != expected:
+            LOGGER.warning('MD5 mismatch for %s (expected %s, got %s)',
+                           scene.name, expected, actual)
+
     def store(self, scene, checksum=False, retry=0):
         if self.is_stored(scene):
             LOGGER.debug('Scene already exists on disk, skipping.')
@@ -265,10 +353,14 @@ class LocalStorage(object):
         for tries in range(0, retry+1):
             LOGGER.debug("Downloading %s, to: %s" % (scene.name, self.directory_path(scene)))
             try:
-                self.handler.download(scene.srcurl, self.scene_path(scene), self.verbose)
+                # Hash while streaming rather than re-reading the finished scene
+                digest = hashlib.md5() if checksum else None
+                self.handler.download(scene.srcurl, self.scene_path(scene), self.verbose,
+                                      digest=digest)
                 if checksum:
-                    scene = scene.checksum()
-                    self.handler.download(scene.srcurl, self.scene_path(scene), self.verbose)
+                    md5 = scene.checksum()
+                    self.handler.download(md5.srcurl, self.scene_path(md5), self.verbose)
+                    self.verify(scene, md5, digest.hexdigest())
                 return
             except Exception as exc:
                 LOGGER.error('Scene not reachable at %s (%s)', scene.srcurl, exc)
@@ -276,7 +368,7 @@ class LocalStorage(object):
 
 
 def main(username, email, order, target_directory, password=None, host=None, verbose=False,
-         checksum=False, retry=0, no_order_directories=False):
+         checksum=False, retry=0, no_order_directories=False, threads=1):
     if not username:
         raise ValueError('Must supply valid username')
     if not password:
@@ -293,18 +385,44 @@ def main(username, email, order, target_directory, password=None, host=None, ver
             orders = [order]
 
         LOGGER.debug('Retrieving orders: {0}'.format(orders))
+        if not orders:
+            LOGGER.warning('No completed orders found')
+            return
 
-        for o in orders:
-            scenes = api.get_completed_scenes(o)
-            if len(scenes) < 1:
-                LOGGER.warning('No scenes in "completed" state for order {}'.format(o))
-
-            for s in range(len(scenes)):
-                LOGGER.info('File {0} of {1} for order: {2}'.format(s + 1, len(scenes), o))
+        def fetch(job):
+            o, count, s, srcurl = job
+            LOGGER.info('File {0} of {1} for order: {2}'.format(s + 1, count, o))
 
-                scene = Scene(scenes[s])
-                storage.store(scene, checksum, retry)
+            scene = Scene(srcurl)
+            storage.store(scene, checksum, retry)
 
+        # Downloads are network-bound, so threads overlap them despite the GIL
+        pool = ThreadPool(threads) if threads > 1 else None
+        try:
+            for o in orders:
+                scenes = api.get_completed_scenes(o)
+                if len(scenes) < 1:
+                    LOGGER.warning('No scenes in "completed" state for order {}'.format(o))
+                    continue
+
+                jobs = [(o, len(scenes), s, srcurl) for s, srcurl in enumerate(scenes)]
+                if pool:
+                    # Results arrive as each scene finishes, so a failure surfaces at
+                    # once; the timeout keeps the wait interruptible on Python 2.7
+                    results = pool.imap_unordered(fetch, jobs)
+                    for _ in jobs:
+                        results.next(POOL_TIMEOUT)
+                else:
+                    for job in jobs:
+                        fetch(job)
+        except BaseException:
+            # Drop queued scenes; in-flight ones keep their .part files for a restart
+            if pool:
+                pool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
 
 if __name__ == '__main__':
     epilog = ('ESPA Bulk Download Client Version 1.0.0. [Tested with Python 2.7]\n'
@@ -374,6 +492,12 @@ if __name__ == '__main__':
                         action='store_true',
                         help='disable generation of order-prefixed directories')
 
+    parser.add_argument('-t', '--threads',
+                        required=False,
+                        type=int,
+                        choices=range(1, 11),
+                        default=1,
+                        help='number of scenes to download concurrently')
 
     parsed_args = parser.parse_args()
 